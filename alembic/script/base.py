@@ -367,7 +367,7 @@ class ScriptDirectory(object):
                 migration.MigrationStep.upgrade_from_script(
                     self.revision_map, script
                 )
-                for script in reversed(list(revs))
+                for script in reversed(revs)
             ]
 
     def _downgrade_revs(self, destination, current_rev):
@@ -1,4 +1,7 @@
+import bisect
 import collections
+import itertools
+import operator
 import re
 
 from sqlalchemy import util as sqlautil
@@ -8,6 +11,9 @@ from ..util import compat
 
 _relative_destination = re.compile(r"(?:(.+?)@)?(\w+)?((?:\+|-)\d+)")
 _revision_illegal_chars = ["@", "-", "+"]
+_revision_illegal_chars_re = re.compile(
+    "[%s]" % re.escape("".join(_revision_illegal_chars))
+)
 
 
 class RevisionError(Exception):
@@ -90,6 +96,9 @@ class RevisionMap(object):
 
         """
         self._generator = generator
+        self._ancestor_cache = sqlautil.LRUCache(20)
+        self._descendant_cache = sqlautil.LRUCache(20)
+        self._ident_cache = {}
 
     @util.memoized_property
     def heads(self):
@@ -147,10 +156,11 @@ class RevisionMap(object):
         # general)
         map_ = sqlautil.OrderedDict()
 
-        heads = sqlautil.OrderedSet()
-        _real_heads = sqlautil.OrderedSet()
-        bases = ()
-        _real_bases = ()
+        # ordered dictionaries with None values serve as ordered sets
+        heads = collections.OrderedDict()
+        _real_heads = collections.OrderedDict()
+        bases = []
+        _real_bases = []
 
         has_branch_labels = set()
         all_revisions = set()
@@ -158,20 +168,21 @@ class RevisionMap(object):
         for revision in self._generator():
             all_revisions.add(revision)
 
-            if revision.revision in map_:
+            existing = map_.setdefault(revision.revision, revision)
+            if existing is not revision:
                 util.warn(
                     "Revision %s is present more than once" % revision.revision
                 )
-            map_[revision.revision] = revision
+                map_[revision.revision] = revision
             if revision.branch_labels:
                 has_branch_labels.add(revision)
 
-            heads.add(revision)
-            _real_heads.add(revision)
+            heads[revision] = None
+            _real_heads[revision] = None
             if revision.is_base:
-                bases += (revision,)
+                bases.append(revision)
             if revision._is_real_base:
-                _real_bases += (revision,)
+                _real_bases.append(revision)
 
         # add the branch_labels to the map_.  We'll need these
         # to resolve the dependencies.
@@ -182,6 +193,8 @@ class RevisionMap(object):
         # names
         self._add_depends_on(all_revisions, map_)
 
+        # gather following revisions, then assign each revision's once
+        nextrevs = collections.defaultdict(list)
         for rev in map_.values():
             for downrev in rev._all_down_revisions:
                 if downrev not in map_:
@@ -190,16 +203,21 @@ class RevisionMap(object):
                         % (downrev, rev)
                     )
                 down_revision = map_[downrev]
-                down_revision.add_nextrev(rev)
+                nextrevs[down_revision].append(rev)
                 if downrev in rev._versioned_down_revisions:
-                    heads.discard(down_revision)
-                _real_heads.discard(down_revision)
+                    heads.pop(down_revision, None)
+                _real_heads.pop(down_revision, None)
+
+        for down_revision, revs in nextrevs.items():
+            down_revision._add_nextrevs(revs)
+
+        self._detect_cycles(rev_map, heads, bases, _real_heads, _real_bases)
 
         # once the map has downrevisions populated, the dependencies
         # can be further refined to include only those which are not
-        # already ancestors
+        # already ancestors.  The map is known to be free of cycles
+        # at this point.
         self._normalize_depends_on(all_revisions, map_)
-        self._detect_cycles(rev_map, heads, bases, _real_heads, _real_bases)
 
         map_[None] = map_[()] = None
         self.heads = tuple(rev.revision for rev in heads)
@@ -210,80 +228,146 @@ class RevisionMap(object):
         self._add_branches(has_branch_labels, map_)
         return map_
 
+    @util.memoized_property
+    def _sorted_revision_ids(self):
+        """Sorted list of string identifiers in the revision map which are
+        eligible for partial identifier matching.
+
+        """
+        return sorted(
+            x
+            for x in self._revision_map
+            if isinstance(x, compat.string_types) and len(x) > 3
+        )
+
+    @util.memoized_property
+    def _revision_map_positions(self):
+        """Position of each identifier within the revision map, used to
+        sort revisions into map order.
+
+        """
+        return {key: idx for idx, key in enumerate(self._revision_map)}
+
+    def _reset_memoizations(self):
+        """Discard collections derived from the revision map, so that they
+        are recomputed after the map has been modified.
+
+        """
+        self._ancestor_cache.clear()
+        self._descendant_cache.clear()
+        self._ident_cache.clear()
+        for name in ("_sorted_revision_ids", "_revision_map_positions"):
+            self.__dict__.pop(name, None)
+
     def _detect_cycles(self, rev_map, heads, bases, _real_heads, _real_bases):
         if not rev_map:
             return
         if not heads or not bases:
             raise CycleDetected(rev_map.keys())
-        total_space = {
-            rev.revision
-            for rev in self._iterate_related_revisions(
-                lambda r: r._versioned_down_revisions, heads, map_=rev_map
-            )
-        }.intersection(
-            rev.revision
-            for rev in self._iterate_related_revisions(
-                lambda r: r.nextrev, bases, map_=rev_map
-            )
+        cyclic_revs = self._cyclic_revisions(
+            rev_map, operator.attrgetter("_versioned_down_revisions")
         )
-        deleted_revs = set(rev_map.keys()) - total_space
-        if deleted_revs:
-            raise CycleDetected(sorted(deleted_revs))
+        if cyclic_revs:
+            raise CycleDetected(sorted(cyclic_revs))
 
         if not _real_heads or not _real_bases:
             raise DependencyCycleDetected(rev_map.keys())
-        total_space = {
-            rev.revision
-            for rev in self._iterate_related_revisions(
-                lambda r: r._all_down_revisions, _real_heads, map_=rev_map
-            )
-        }.intersection(
-            rev.revision
-            for rev in self._iterate_related_revisions(
-                lambda r: r._all_nextrev, _real_bases, map_=rev_map
-            )
+        cyclic_revs = self._cyclic_revisions(
+            rev_map, operator.attrgetter("_all_down_revisions")
         )
-        deleted_revs = set(rev_map.keys()) - total_space
-        if deleted_revs:
-            raise DependencyCycleDetected(sorted(deleted_revs))
+        if cyclic_revs:
+            raise DependencyCycleDetected(sorted(cyclic_revs))
+
+    def _cyclic_revisions(self, rev_map, fn):
+        """Return the set of revision ids which are part of a cycle, where
+        fn(rev) returns the ids that a revision points to.
+
+        This is an iterative form of Tarjan's strongly connected components
+        algorithm; any component with more than one member, or a member
+        pointing to itself, is a cycle.
+
+        """
+        index = {}
+        lowlink = {}
+        stack = []
+        on_stack = set()
+        cyclic = set()
+
+        for root in rev_map:
+            if root in index:
+                continue
+            index[root] = lowlink[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            work = [(root, iter(fn(rev_map[root])))]
+
+            while work:
+                node, edges = work[-1]
+                for next_ in edges:
+                    if next_ not in index:
+                        index[next_] = lowlink[next_] = len(index)
+                        stack.append(next_)
+                        on_stack.add(next_)
+                        work.append((next_, iter(fn(rev_map[next_]))))
+                        break
+                    elif next_ in on_stack:
+                        lowlink[node] = min(lowlink[node], index[next_])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        lowlink[parent] = min(lowlink[parent], lowlink[node])
+                    if lowlink[node] == index[node]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            on_stack.discard(member)
+                            component.append(member)
+                            if member == node:
+                                break
+                        if len(component) > 1 or node in fn(rev_map[node]):
+                            cyclic.update(component)
+        return cyclic
 
     def _map_branch_labels(self, revisions, map_):
         for revision in revisions:
             if revision.branch_labels:
                 for branch_label in revision._orig_branch_labels:
-                    if branch_label in map_:
+                    existing = map_.setdefault(branch_label, revision)
+                    if (
+                        existing is not revision
+                        or branch_label == revision.revision
+                    ):
                         raise RevisionError(
                             "Branch name '%s' in revision %s already "
                             "used by revision %s"
                             % (
                                 branch_label,
                                 revision.revision,
-                                map_[branch_label].revision,
+                                existing.revision,
                             )
                         )
-                    map_[branch_label] = revision
 
     def _add_branches(self, revisions, map_):
         for revision in revisions:
             if revision.branch_labels:
-                revision.branch_labels.update(revision.branch_labels)
+                # labels apply to all descendants; when the descendants
+                # form a single unbroken line, they apply as well to the
+                # ancestors down to the nearest branch or merge point
+                unbroken = True
                 for node in self._get_descendant_nodes(
                     [revision], map_, include_dependencies=False
                 ):
                     node.branch_labels.update(revision.branch_labels)
+                    if node._is_real_branch_point or node.is_merge_point:
+                        unbroken = False
 
-                parent = node
-                while (
-                    parent
-                    and not parent._is_real_branch_point
-                    and not parent.is_merge_point
-                ):
-
-                    parent.branch_labels.update(revision.branch_labels)
-                    if parent.down_revision:
-                        parent = map_[parent.down_revision]
-                    else:
+                parent = revision
+                while unbroken and parent.down_revision:
+                    parent = map_[parent.down_revision]
+                    if parent._is_real_branch_point or parent.is_merge_point:
                         break
+                    parent.branch_labels.update(revision.branch_labels)
 
     def _add_depends_on(self, revisions, map_):
         """Resolve the 'dependencies' for each revision in a collection
@@ -323,18 +407,19 @@ class RevisionMap(object):
 
         """
 
+        # resolved dependencies of each revision along with those of all
+        # of its ancestors, shared among the revisions being normalized
+        inherited = {}
+
         for revision in revisions:
             if revision._resolved_dependencies:
                 normalized_resolved = set(revision._resolved_dependencies)
-                for rev in self._get_ancestor_nodes(
-                    [revision], include_dependencies=False, map_=map_
-                ):
-                    if rev is revision:
-                        continue
-                    elif rev._resolved_dependencies:
-                        normalized_resolved.difference_update(
-                            rev._resolved_dependencies
+                for downrev in revision._versioned_down_revisions:
+                    normalized_resolved.difference_update(
+                        self._inherited_dependencies(
+                            map_[downrev], map_, inherited
                         )
+                    )
 
                 revision._normalized_resolved_dependencies = tuple(
                     normalized_resolved
@@ -342,6 +427,47 @@ class RevisionMap(object):
             else:
                 revision._normalized_resolved_dependencies = ()
 
+    def _inherited_dependencies(self, target, map_, memo):
+        """Return the resolved dependencies of a revision and all of its
+        ancestors, following down_revision only.
+
+        Results are stored in the memo dictionary keyed on revision id, so
+        that each revision is computed once no matter how many descendants
+        ask for it.  A revision without dependencies of its own and with a
+        single down revision shares the collection of that down revision.
+
+        """
+        todo = [target]
+        while todo:
+            rev = todo[-1]
+            if rev.revision in memo:
+                todo.pop()
+                continue
+            pending = []
+            for downrev in rev._versioned_down_revisions:
+                if downrev not in memo:
+                    down_revision = map_[downrev]
+                    if down_revision.revision != downrev:
+                        raise RevisionError(
+                            "Dependency resolution failed; broken map"
+                        )
+                    pending.append(down_revision)
+            if pending:
+                todo.extend(pending)
+                continue
+
+            todo.pop()
+            down_deps = [
+                memo[downrev] for downrev in rev._versioned_down_revisions
+            ]
+            if not rev._resolved_dependencies and len(down_deps) == 1:
+                memo[rev.revision] = down_deps[0]
+            else:
+                memo[rev.revision] = frozenset(
+                    rev._resolved_dependencies
+                ).union(*down_deps)
+        return memo[target.revision]
+
     def add_revision(self, revision, _replace=False):
         """add a single revision to an existing map.
 
@@ -358,6 +484,7 @@ class RevisionMap(object):
             raise Exception("revision %s not in map" % revision.revision)
 
         map_[revision.revision] = revision
+        self._reset_memoizations()
 
         revisions = [revision]
         self._add_branches(revisions, map_)
@@ -380,22 +507,20 @@ class RevisionMap(object):
         self._normalize_depends_on(revisions, map_)
 
         if revision._is_real_head:
+            all_down_revisions = set(revision._all_down_revisions)
+            all_down_revisions.add(revision.revision)
             self._real_heads = tuple(
                 head
                 for head in self._real_heads
-                if head
-                not in set(revision._all_down_revisions).union(
-                    [revision.revision]
-                )
+                if head not in all_down_revisions
             ) + (revision.revision,)
         if revision.is_head:
+            versioned_down_revisions = set(revision._versioned_down_revisions)
+            versioned_down_revisions.add(revision.revision)
             self.heads = tuple(
                 head
                 for head in self.heads
-                if head
-                not in set(revision._versioned_down_revisions).union(
-                    [revision.revision]
-                )
+                if head not in versioned_down_revisions
             ) + (revision.revision,)
 
     def get_current_head(self, branch_label=None):
@@ -454,8 +579,22 @@ class RevisionMap(object):
         """
 
         if isinstance(id_, (list, tuple, set, frozenset)):
-            return sum([self.get_revisions(id_elem) for id_elem in id_], ())
+            return tuple(
+                itertools.chain.from_iterable(
+                    self.get_revisions(id_elem) for id_elem in id_
+                )
+            )
         else:
+            if isinstance(id_, compat.string_types) and id_ not in (
+                "heads",
+                "head",
+                "base",
+            ):
+                # an exact revision id needs no further resolution
+                revision = self._revision_map.get(id_)
+                if revision is not None and revision.revision == id_:
+                    return (revision,)
+
             resolved_id, branch_label = self._resolve_revision_number(id_)
             if len(resolved_id) == 1:
                 try:
@@ -522,23 +661,40 @@ class RevisionMap(object):
             return branch_rev
 
     def _revision_for_ident(self, resolved_id, check_branch=None):
+        key = (resolved_id, check_branch)
+        try:
+            return self._ident_cache[key]
+        except KeyError:
+            pass
+
+        # resolve outside of the except block to avoid misleading py3k
+        # stack traces; failed resolutions raise and are not cached
+        revision = self._ident_cache[key] = self._lookup_revision_for_ident(
+            resolved_id, check_branch
+        )
+        return revision
+
+    def _lookup_revision_for_ident(self, resolved_id, check_branch):
         if check_branch:
             branch_rev = self._resolve_branch(check_branch)
         else:
             branch_rev = None
 
+        map_ = self._revision_map
         try:
-            revision = self._revision_map[resolved_id]
+            revision = map_[resolved_id]
         except KeyError:
             # break out to avoid misleading py3k stack traces
             revision = False
         if revision is False:
-            # do a partial lookup
-            revs = [
-                x
-                for x in self._revision_map
-                if x and len(x) > 3 and x.startswith(resolved_id)
-            ]
+            # do a partial lookup; identifiers sharing the given prefix
+            # are contiguous within the sorted list
+            ids = self._sorted_revision_ids
+            revs = []
+            for idx in range(bisect.bisect_left(ids, resolved_id), len(ids)):
+                if not ids[idx].startswith(resolved_id):
+                    break
+                revs.append(ids[idx])
 
             if branch_rev:
                 revs = self.filter_for_lineage(revs, check_branch)
@@ -564,7 +720,7 @@ class RevisionMap(object):
                     resolved_id,
                 )
             else:
-                revision = self._revision_map[revs[0]]
+                revision = map_[revs[0]]
 
         if check_branch and revision is not None:
             if not self._shares_lineage(
@@ -580,12 +736,19 @@ class RevisionMap(object):
     def _filter_into_branch_heads(self, targets):
         targets = set(targets)
 
-        for rev in list(targets):
-            if targets.intersection(
-                self._get_descendant_nodes([rev], include_dependencies=False)
-            ).difference([rev]):
-                targets.discard(rev)
-        return targets
+        # a target is a branch head unless it's an ancestor of another
+        # target; walk down from the parents of all targets at once
+        map_ = self._revision_map
+        ancestors = self._iterate_related_revisions(
+            operator.attrgetter("_versioned_down_revisions"),
+            [
+                map_[downrev]
+                for rev in targets
+                for downrev in rev._versioned_down_revisions
+            ],
+            map_=map_,
+        )
+        return targets.difference(ancestors)
 
     def filter_for_lineage(
         self, targets, check_against, include_dependencies=False
@@ -598,13 +761,40 @@ class RevisionMap(object):
         if id_:
             shares.extend(id_)
 
-        return [
-            tg
-            for tg in targets
-            if self._shares_lineage(
-                tg, shares, include_dependencies=include_dependencies
+        targets = list(targets)
+        if not targets or not shares:
+            return targets
+
+        # a target shares lineage with a revision if it is one of that
+        # revision's descendants or ancestors; resolve each of these
+        # collections once rather than traversing from every target
+        lineages = []
+        for share in shares:
+            share_rev = self._revision_for_ident(share)
+            lineages.append(
+                self._get_descendant_nodes(
+                    [share_rev],
+                    include_dependencies=include_dependencies,
+                    memoize=True,
+                )
+            )
+            lineages.append(
+                self._get_ancestor_nodes(
+                    [share_rev],
+                    include_dependencies=include_dependencies,
+                    memoize=True,
+                )
             )
-        ]
+
+        result = []
+        for tg in targets:
+            if not isinstance(tg, Revision):
+                tg_rev = self._revision_for_ident(tg)
+            else:
+                tg_rev = tg
+            if any(tg_rev in lineage for lineage in lineages):
+                result.append(tg)
+        return result
 
     def _shares_lineage(
         self, target, test_against_revs, include_dependencies=False
@@ -614,27 +804,25 @@ class RevisionMap(object):
         if not isinstance(target, Revision):
             target = self._revision_for_ident(target)
 
-        test_against_revs = [
+        test_against_revs = frozenset(
             self._revision_for_ident(test_against_rev)
             if not isinstance(test_against_rev, Revision)
             else test_against_rev
             for test_against_rev in util.to_tuple(
                 test_against_revs, default=()
             )
-        ]
+        )
 
-        return bool(
-            set(
-                self._get_descendant_nodes(
-                    [target], include_dependencies=include_dependencies
-                )
+        # isdisjoint() stops at the first common revision; the ancestors
+        # are only consulted if no descendant matched
+        return not test_against_revs.isdisjoint(
+            self._get_descendant_nodes(
+                [target], include_dependencies=include_dependencies
             )
-            .union(
-                self._get_ancestor_nodes(
-                    [target], include_dependencies=include_dependencies
-                )
+        ) or not test_against_revs.isdisjoint(
+            self._get_ancestor_nodes(
+                [target], include_dependencies=include_dependencies
             )
-            .intersection(test_against_revs)
         )
 
     def _resolve_revision_number(self, id_):
@@ -711,8 +899,11 @@ class RevisionMap(object):
             assert_relative_length=assert_relative_length,
         )
 
+        # the sort yields exact revision ids, so look them up in the map
+        # directly rather than resolving each one as an identifier
+        map_ = self._revision_map
         for node in self._topological_sort(revisions, heads):
-            yield self.get_revision(node)
+            yield map_[node]
 
     def _get_descendant_nodes(
         self,
@@ -721,6 +912,7 @@ class RevisionMap(object):
         check=False,
         omit_immediate_dependencies=False,
         include_dependencies=True,
+        memoize=False,
     ):
 
         if omit_immediate_dependencies:
@@ -732,57 +924,129 @@ class RevisionMap(object):
                     return rev.nextrev
 
         elif include_dependencies:
-
-            def fn(rev):
-                return rev._all_nextrev
-
+            fn = operator.attrgetter("_all_nextrev")
         else:
-
-            def fn(rev):
-                return rev.nextrev
-
+            fn = operator.attrgetter("nextrev")
+
+        if memoize and map_ is None and not omit_immediate_dependencies:
+            return self._get_cached_related_revisions(
+                self._descendant_cache,
+                fn,
+                targets,
+                include_dependencies,
+                check,
+            )
         return self._iterate_related_revisions(
             fn, targets, map_=map_, check=check
         )
 
     def _get_ancestor_nodes(
-        self, targets, map_=None, check=False, include_dependencies=True
+        self,
+        targets,
+        map_=None,
+        check=False,
+        include_dependencies=True,
+        memoize=False,
     ):
 
         if include_dependencies:
-
-            def fn(rev):
-                return rev._normalized_down_revisions
-
+            fn = operator.attrgetter("_normalized_down_revisions")
         else:
+            fn = operator.attrgetter("_versioned_down_revisions")
 
-            def fn(rev):
-                return rev._versioned_down_revisions
-
+        if memoize and map_ is None:
+            return self._get_cached_related_revisions(
+                self._ancestor_cache, fn, targets, include_dependencies, check
+            )
         return self._iterate_related_revisions(
             fn, targets, map_=map_, check=check
         )
 
+    def _get_cached_related_revisions(
+        self, cache, fn, targets, include_dependencies, check=False
+    ):
+        """Return the revisions related to a collection of targets,
+        memoizing the result in the given cache.
+
+        Used only when ``memoize=True`` is passed, by the upgrade and
+        downgrade planning that repeats the same traversals; each entry
+        holds a set as large as the traversal, so the caches are bounded
+        LRU caches.  They're cleared by :meth:`.RevisionMap.add_revision`.
+
+        A single target can't overlap with any other requested revision,
+        so checked traversals from more than one target aren't cached.
+
+        """
+        if check and len(targets) != 1:
+            return self._iterate_related_revisions(
+                fn, targets, map_=None, check=True
+            )
+
+        key = (
+            frozenset([target.revision for target in targets]),
+            include_dependencies,
+        )
+        result = cache.get(key)
+        if result is None:
+            cache[key] = result = frozenset(
+                self._iterate_related_revisions(fn, targets, map_=None)
+            )
+        return result
+
     def _iterate_related_revisions(self, fn, targets, map_, check=False):
         if map_ is None:
             map_ = self._revision_map
 
+        if not check:
+            return self._iterate_related_revisions_nocheck(fn, targets, map_)
+
+        return self._iterate_related_revisions_check(fn, targets, map_)
+
+    def _iterate_related_revisions_nocheck(self, fn, targets, map_):
+        # walk all targets at once; the seen set is the result
         seen = set()
-        todo = collections.deque()
+        seen_add = seen.add
+        todo = list(targets)
+        todo_pop = todo.pop
+        todo_append = todo.append
+        while todo:
+            rev = todo_pop()
+            if rev in seen:
+                continue
+            seen_add(rev)
+            # Check for map errors before collecting.
+            for rev_id in fn(rev):
+                next_rev = map_[rev_id]
+                if next_rev.revision != rev_id:
+                    raise RevisionError(
+                        "Dependency resolution failed; broken map"
+                    )
+                if next_rev not in seen:
+                    todo_append(next_rev)
+        return seen
+
+    def _iterate_related_revisions_check(self, fn, targets, map_):
+        seen = set()
+        seen_add = seen.add
+        todo = []
+        todo_pop = todo.pop
+        todo_append = todo.append
+        # another target overlaps with the current one if it's popped,
+        # or found already seen, while walking from the current target
+        target_set = set(targets)
         for target in targets:
 
-            todo.append(target)
-            if check:
-                per_target = set()
+            todo_append(target)
+            overlaps = set()
 
             while todo:
-                rev = todo.pop()
-                if check:
-                    per_target.add(rev)
+                rev = todo_pop()
+                if rev in target_set and rev is not target:
+                    overlaps.add(rev)
 
                 if rev in seen:
                     continue
-                seen.add(rev)
+                seen_add(rev)
                 # Check for map errors before collecting.
                 for rev_id in fn(rev):
                     next_rev = map_[rev_id]
@@ -790,21 +1054,20 @@ class RevisionMap(object):
                         raise RevisionError(
                             "Dependency resolution failed; broken map"
                         )
-                    todo.append(next_rev)
-                yield rev
-            if check:
-                overlaps = per_target.intersection(targets).difference(
-                    [target]
-                )
-                if overlaps:
-                    raise RevisionError(
-                        "Requested revision %s overlaps with "
-                        "other requested revisions %s"
-                        % (
-                            target.revision,
-                            ", ".join(r.revision for r in overlaps),
-                        )
+                    if next_rev not in seen:
+                        todo_append(next_rev)
+                    elif next_rev in target_set:
+                        overlaps.add(next_rev)
+            if overlaps:
+                raise RevisionError(
+                    "Requested revision %s overlaps with "
+                    "other requested revisions %s"
+                    % (
+                        target.revision,
+                        ", ".join(r.revision for r in overlaps),
                     )
+                )
+        return seen
 
     def _topological_sort(self, revisions, heads):
         """Yield revision ids of a collection of Revision objects in
@@ -825,14 +1088,11 @@ class RevisionMap(object):
         todo = {d.revision for d in revisions}
 
         # Use revision map (ordered dict) key order to pre-sort.
-        inserted_order = list(self._revision_map)
-
-        current_heads = list(
-            sorted(
-                {d.revision for d in heads if d.revision in todo},
-                key=inserted_order.index,
-            )
+        current_heads = sorted(
+            {d.revision for d in heads if d.revision in todo},
+            key=self._revision_map_positions.__getitem__,
         )
+        current_head_set = set(current_heads)
         ancestors_by_idx = [get_ancestors(rev_id) for rev_id in current_heads]
 
         output = []
@@ -866,15 +1126,18 @@ class RevisionMap(object):
                 heads_to_add = [
                     r
                     for r in candidate_rev._normalized_down_revisions
-                    if r in todo and r not in current_heads
+                    if r in todo and r not in current_head_set
                 ]
 
                 if not heads_to_add:
                     # no ancestors, so remove this head from the list
+                    current_head_set.discard(candidate)
                     del current_heads[current_candidate_idx]
                     del ancestors_by_idx[current_candidate_idx]
                     current_candidate_idx = max(current_candidate_idx - 1, 0)
                 else:
+                    current_head_set.discard(candidate)
+                    current_head_set.update(heads_to_add)
 
                     if (
                         not candidate_rev._normalized_resolved_dependencies
@@ -924,26 +1187,38 @@ class RevisionMap(object):
         if isinstance(start, compat.string_types):
             start = self.get_revision(start)
 
+        # bases, heads and the revisions adjacent to a revision are all
+        # exact revision ids, so they're looked up in the map directly;
+        # unless branches need filtering, more than one of them is an
+        # ambiguous walk before any are looked up
+        map_ = self._revision_map
         for _ in range(abs(steps)):
             if steps > 0:
                 # Walk up
-                children = [
-                    rev
-                    for rev in self.get_revisions(
-                        self.bases if start is None else start.nextrev
-                    )
-                ]
+                child_ids = self.bases if start is None else start.nextrev
                 if branch_label:
-                    children = self.filter_for_lineage(children, branch_label)
+                    children = self.filter_for_lineage(
+                        [map_[rev_id] for rev_id in child_ids], branch_label
+                    )
+                elif len(child_ids) > 1:
+                    raise RevisionError("Ambiguous walk")
+                else:
+                    children = [map_[rev_id] for rev_id in child_ids]
             else:
                 # Walk down
                 if start == "base":
                     children = tuple()
                 else:
-                    children = self.get_revisions(
-                        self.heads if start is None else start.down_revision
+                    child_ids = (
+                        self.heads
+                        if start is None
+                        else start._versioned_down_revisions
                     )
-                    if not children:
+                    if len(child_ids) > 1:
+                        raise RevisionError("Ambiguous walk")
+                    elif child_ids:
+                        children = (map_[child_ids[0]],)
+                    else:
                         children = ("base",)
             if not children:
                 # This will return an invalid result if no_overwalk, otherwise
@@ -975,7 +1250,11 @@ class RevisionMap(object):
         assert isinstance(
             target, compat.string_types
         ), "Expected downgrade target in string form"
-        match = _relative_destination.match(target)
+        if "+" in target or "-" in target:
+            match = _relative_destination.match(target)
+        else:
+            # relative destinations always contain a sign
+            match = None
         if match:
             branch_label, symbol, relative = match.groups()
             rel_int = int(relative)
@@ -1061,9 +1340,12 @@ class RevisionMap(object):
         to. The target may be specified in absolute form, or relative to
         :current_revisions.
         """
-        if isinstance(target, compat.string_types):
+        if isinstance(target, compat.string_types) and (
+            "+" in target or "-" in target
+        ):
             match = _relative_destination.match(target)
         else:
+            # relative destinations are strings that always contain a sign
             match = None
 
         if not match:
@@ -1082,16 +1364,17 @@ class RevisionMap(object):
                 # Try to filter to a single target (avoid ambiguous branches).
                 start_revs = current_revisions
                 if branch_label:
+                    current_revision_objs = self.get_revisions(
+                        current_revisions
+                    )
                     start_revs = self.filter_for_lineage(
-                        self.get_revisions(current_revisions), branch_label
+                        current_revision_objs, branch_label
                     )
                     if not start_revs:
                         # The requested branch is not a head, so we need to
                         # backtrack to find a branchpoint.
                         active_on_branch = self.filter_for_lineage(
-                            self._get_ancestor_nodes(
-                                self.get_revisions(current_revisions)
-                            ),
+                            self._get_ancestor_nodes(current_revision_objs),
                             branch_label,
                         )
                         # Find the tips of this set of revisions (revisions
@@ -1172,37 +1455,31 @@ class RevisionMap(object):
             target_revision = None
         assert target_revision is None or isinstance(target_revision, Revision)
 
+        map_ = self._revision_map
+
         # Find candidates to drop.
         if target_revision is None:
             # Downgrading back to base: find all tree roots.
-            roots = [
-                rev
-                for rev in self._revision_map.values()
-                if rev is not None and rev.down_revision is None
-            ]
+            roots = [map_[rev_id] for rev_id in self.bases]
         elif inclusive:
             # inclusive implies target revision should also be dropped
             roots = [target_revision]
         else:
             # Downgrading to fixed target: find all direct children.
-            roots = list(self.get_revisions(target_revision.nextrev))
+            roots = [map_[rev_id] for rev_id in target_revision.nextrev]
 
         if branch_label and len(roots) > 1:
             # Need to filter roots.
-            ancestors = {
-                rev.revision
-                for rev in self._get_ancestor_nodes(
+            ancestors = frozenset(
+                self._get_ancestor_nodes(
                     [self._resolve_branch(branch_label)],
                     include_dependencies=False,
+                    memoize=True,
                 )
-            }
+            )
             # Intersection gives the root revisions we are trying to
             # rollback with the downgrade.
-            roots = list(
-                self.get_revisions(
-                    {rev.revision for rev in roots}.intersection(ancestors)
-                )
-            )
+            roots = list(ancestors.intersection(roots))
 
             # Ensure we didn't throw everything away when filtering branches.
             if len(roots) == 0:
@@ -1212,26 +1489,31 @@ class RevisionMap(object):
 
         heads = self.get_revisions(upper)
 
+        # memoized traversals are already frozensets
+        active_revisions = frozenset(
+            self._get_ancestor_nodes(
+                heads, include_dependencies=True, memoize=True
+            )
+        )
+
         # Aim is to drop :branch_revision; to do so we also need to drop its
-        # descendents and anything dependent on it.
-        downgrade_revisions = set(
+        # descendents and anything dependent on it.  Emit revisions to drop
+        # in reverse topological sorted order.
+        downgrade_revisions = active_revisions.intersection(
             self._get_descendant_nodes(
                 roots,
                 include_dependencies=True,
                 omit_immediate_dependencies=False,
+                memoize=True,
             )
         )
-        active_revisions = set(
-            self._get_ancestor_nodes(heads, include_dependencies=True)
-        )
-
-        # Emit revisions to drop in reverse topological sorted order.
-        downgrade_revisions.intersection_update(active_revisions)
 
         if implicit_base:
             # Wind other branches back to base.
-            downgrade_revisions.update(
-                active_revisions.difference(self._get_ancestor_nodes(roots))
+            downgrade_revisions = downgrade_revisions.union(
+                active_revisions.difference(
+                    self._get_ancestor_nodes(roots, memoize=True)
+                )
             )
 
         if (
@@ -1281,11 +1563,11 @@ class RevisionMap(object):
                 need for need in targets if branch in need.branch_labels
             }
 
-        required_node_set = set(
+        required_node_set = frozenset(
             self._get_ancestor_nodes(
-                targets, check=True, include_dependencies=True
+                targets, check=True, include_dependencies=True, memoize=True
             )
-        ).union(targets)
+        )
 
         current_revisions = self.get_revisions(lower)
         if not implicit_base and any(
@@ -1313,26 +1595,38 @@ class RevisionMap(object):
                 current_revisions = (rev,)
                 lower = rev.revision
 
-        current_node_set = set(
+        if not inclusive and frozenset(current_revisions) == frozenset(
+            targets
+        ):
+            # already at the requested revisions; nothing to upgrade
+            return frozenset(), targets
+
+        current_node_set = frozenset(
             self._get_ancestor_nodes(
-                current_revisions, check=True, include_dependencies=True
+                current_revisions,
+                check=True,
+                include_dependencies=True,
+                memoize=True,
             )
-        ).union(current_revisions)
+        )
 
         needs = required_node_set.difference(current_node_set)
 
         # Include the lower revision (=current_revisions?) in the iteration
         if inclusive:
-            needs.update(self.get_revisions(lower))
+            needs = needs.union(self.get_revisions(lower))
         # By default, base is implicit as we want all dependencies returned.
         # Base is also implicit if lower = base
         # implicit_base=False -> only return direct downstreams of
         # current_revisions
         if current_revisions and not implicit_base:
             lower_descendents = self._get_descendant_nodes(
-                current_revisions, check=True, include_dependencies=False
+                current_revisions,
+                check=True,
+                include_dependencies=False,
+                memoize=True,
             )
-            needs.intersection_update(lower_descendents)
+            needs = needs.intersection(lower_descendents)
 
         return needs, targets
 
@@ -1353,6 +1647,43 @@ class Revision(object):
 
     _all_nextrev = frozenset()
 
+    is_head = True
+    """True if this :class:`.Revision` is a 'head' revision.
+
+    This is determined based on whether any other :class:`.Script`
+    within the :class:`.ScriptDirectory` refers to this
+    :class:`.Script`.   Multiple heads can be present.
+
+    """
+
+    _is_real_head = True
+
+    is_branch_point = False
+    """True if this :class:`.Script` is a branch point.
+
+    A branchpoint is defined as a :class:`.Script` which is referred
+    to by more than one succeeding :class:`.Script`, that is more
+    than one :class:`.Script` has a `down_revision` identifier pointing
+    here.
+
+    """
+
+    _is_real_branch_point = False
+    """True if this :class:`.Script` is a 'real' branch point,
+    taking into account dependencies as well.
+
+    """
+
+    is_base = True
+    """True if this :class:`.Revision` is a 'base' revision."""
+
+    _is_real_base = True
+    """True if this :class:`.Revision` is a "real" base revision,
+    e.g. that it has no dependencies either."""
+
+    is_merge_point = False
+    """True if this :class:`.Script` is a merge point."""
+
     revision = None
     """The string revision number."""
 
@@ -1380,8 +1711,8 @@ class Revision(object):
 
     @classmethod
     def verify_rev_id(cls, revision):
-        illegal_chars = set(revision).intersection(_revision_illegal_chars)
-        if illegal_chars:
+        if _revision_illegal_chars_re.search(revision):
+            illegal_chars = set(revision).intersection(_revision_illegal_chars)
             raise RevisionError(
                 "Character(s) '%s' not allowed in revision identifier '%s'"
                 % (", ".join(sorted(illegal_chars)), revision)
@@ -1390,7 +1721,11 @@ class Revision(object):
     def __init__(
         self, revision, down_revision, dependencies=None, branch_labels=None
     ):
-        if down_revision and revision in util.to_tuple(down_revision):
+        down_revision = tuple_rev_as_scalar(down_revision)
+        dependencies = tuple_rev_as_scalar(dependencies)
+        versioned_down_revisions = util.to_tuple(down_revision, default=())
+
+        if revision in versioned_down_revisions:
             raise LoopDetected(revision)
         elif dependencies is not None and revision in util.to_tuple(
             dependencies
@@ -1399,8 +1734,14 @@ class Revision(object):
 
         self.verify_rev_id(revision)
         self.revision = revision
-        self.down_revision = tuple_rev_as_scalar(down_revision)
-        self.dependencies = tuple_rev_as_scalar(dependencies)
+        self.down_revision = down_revision
+        self.dependencies = dependencies
+        self._versioned_down_revisions = versioned_down_revisions
+        self.is_base = self.down_revision is None
+        # we use self.dependencies here because this is consulted
+        # in initialization where _resolved_dependencies isn't set up yet
+        self._is_real_base = self.is_base and self.dependencies is None
+        self.is_merge_point = len(self._versioned_down_revisions) > 1
         self._orig_branch_labels = util.to_tuple(branch_labels, default=())
         self.branch_labels = set(self._orig_branch_labels)
 
@@ -1413,89 +1754,55 @@ class Revision(object):
         return "%s(%s)" % (self.__class__.__name__, ", ".join(args))
 
     def add_nextrev(self, revision):
-        self._all_nextrev = self._all_nextrev.union([revision.revision])
-        if self.revision in revision._versioned_down_revisions:
-            self.nextrev = self.nextrev.union([revision.revision])
+        self._add_nextrevs([revision])
+
+    def _add_nextrevs(self, revisions):
+        self._all_nextrev = self._all_nextrev | {
+            revision.revision for revision in revisions
+        }
+        self._is_real_head = False
+        self._is_real_branch_point = len(self._all_nextrev) > 1
+
+        nextrev = {
+            revision.revision
+            for revision in revisions
+            if self.revision in revision._versioned_down_revisions
+        }
+        if nextrev:
+            self.nextrev = self.nextrev | nextrev
+            self.is_head = False
+            self.is_branch_point = len(self.nextrev) > 1
 
     @property
-    def _all_down_revisions(self):
-        return util.dedupe_tuple(
-            util.to_tuple(self.down_revision, default=())
-            + self._resolved_dependencies
+    def _resolved_dependencies(self):
+        return self.__resolved_dependencies
+
+    @_resolved_dependencies.setter
+    def _resolved_dependencies(self, resolved_dependencies):
+        # consulted on every hop of a traversal
+        self.__resolved_dependencies = resolved_dependencies
+        self._all_down_revisions = util.dedupe_tuple(
+            self._versioned_down_revisions + resolved_dependencies
         )
 
     @property
-    def _normalized_down_revisions(self):
-        """return immediate down revisions for a rev, omitting dependencies
-        that are still dependencies of ancestors.
+    def _normalized_resolved_dependencies(self):
+        """resolved dependencies, omitting those that are already
+        dependencies of ancestors.
 
         """
-        return util.dedupe_tuple(
-            util.to_tuple(self.down_revision, default=())
-            + self._normalized_resolved_dependencies
+        return self.__normalized_resolved_dependencies
+
+    @_normalized_resolved_dependencies.setter
+    def _normalized_resolved_dependencies(self, normalized_dependencies):
+        # _normalized_down_revisions are the immediate down revisions for
+        # a rev, omitting dependencies that are still dependencies of
+        # ancestors
+        self.__normalized_resolved_dependencies = normalized_dependencies
+        self._normalized_down_revisions = util.dedupe_tuple(
+            self._versioned_down_revisions + normalized_dependencies
         )
 
-    @property
-    def _versioned_down_revisions(self):
-        return util.to_tuple(self.down_revision, default=())
-
-    @property
-    def is_head(self):
-        """Return True if this :class:`.Revision` is a 'head' revision.
-
-        This is determined based on whether any other :class:`.Script`
-        within the :class:`.ScriptDirectory` refers to this
-        :class:`.Script`.   Multiple heads can be present.
-
-        """
-        return not bool(self.nextrev)
-
-    @property
-    def _is_real_head(self):
-        return not bool(self._all_nextrev)
-
-    @property
-    def is_base(self):
-        """Return True if this :class:`.Revision` is a 'base' revision."""
-
-        return self.down_revision is None
-
-    @property
-    def _is_real_base(self):
-        """Return True if this :class:`.Revision` is a "real" base revision,
-        e.g. that it has no dependencies either."""
-
-        # we use self.dependencies here because this is called up
-        # in initialization where _real_dependencies isn't set up
-        # yet
-        return self.down_revision is None and self.dependencies is None
-
-    @property
-    def is_branch_point(self):
-        """Return True if this :class:`.Script` is a branch point.
-
-        A branchpoint is defined as a :class:`.Script` which is referred
-        to by more than one succeeding :class:`.Script`, that is more
-        than one :class:`.Script` has a `down_revision` identifier pointing
-        here.
-
-        """
-        return len(self.nextrev) > 1
-
-    @property
-    def _is_real_branch_point(self):
-        """Return True if this :class:`.Script` is a 'real' branch point,
-        taking into account dependencies as well.
-
-        """
-        return len(self._all_nextrev) > 1
-
-    @property
-    def is_merge_point(self):
-        """Return True if this :class:`.Script` is a merge point."""
-
-        return len(self._versioned_down_revisions) > 1
-
 
 def tuple_rev_as_scalar(rev):
     if not rev:
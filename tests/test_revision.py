@@ -79,6 +79,58 @@ class APITest(TestBase):
         map_.add_revision(Revision("d1", ("c1",)))
         eq_(map_.heads, ("c2", "d1"))
 
+    def test_add_revision_related_nodes(self):
+        map_ = RevisionMap(
+            lambda: [
+                Revision("a", ()),
+                Revision("b", ("a",)),
+            ]
+        )
+        a, b = map_.get_revisions(("a", "b"))
+        eq_(set(map_._get_descendant_nodes([a], memoize=True)), {a, b})
+
+        c = Revision("c", ("b",))
+        map_.add_revision(c)
+        eq_(set(map_._get_descendant_nodes([a], memoize=True)), {a, b, c})
+        eq_(set(map_._get_ancestor_nodes([c], memoize=True)), {a, b, c})
+
+    def test_add_revision_related_nodes_multiple_targets(self):
+        map_ = RevisionMap(
+            lambda: [
+                Revision("a", ()),
+                Revision("b", ("a",)),
+                Revision("c", ("a",)),
+            ]
+        )
+        a, b, c = map_.get_revisions(("a", "b", "c"))
+        eq_(set(map_._get_ancestor_nodes([b, c], memoize=True)), {a, b, c})
+        eq_(set(map_._get_descendant_nodes([b, c], memoize=True)), {b, c})
+
+        d = Revision("d", ("b", "c"))
+        map_.add_revision(d)
+        eq_(
+            set(map_._get_descendant_nodes([c, b], memoize=True)),
+            {b, c, d},
+        )
+
+    def test_add_revision_partial_ident(self):
+        map_ = RevisionMap(
+            lambda: [
+                Revision("aaaa1", ()),
+                Revision("bbbb1", ("aaaa1",)),
+            ]
+        )
+        eq_(map_.get_revision("bbbb"), map_._revision_map["bbbb1"])
+
+        map_.add_revision(Revision("bbbb2", ("bbbb1",)))
+        eq_(map_.get_revision("bbbb2"), map_._revision_map["bbbb2"])
+        assert_raises_message(
+            RevisionError,
+            "Multiple revisions start with 'bbbb': 'bbbb1', 'bbbb2'",
+            map_.get_revision,
+            "bbbb",
+        )
+
     def test_get_revision_head_single(self):
         map_ = RevisionMap(
             lambda: [
@@ -195,6 +247,28 @@ class APITest(TestBase):
             ["c", "b"],
         )
 
+    def test_branch_label_listed_twice(self):
+        map_ = RevisionMap(
+            lambda: [
+                Revision("a", (), branch_labels=["foo", "foo"]),
+                Revision("b", ("a",)),
+            ]
+        )
+        eq_(map_.get_revision("foo@head"), map_._revision_map["b"])
+
+    def test_branch_label_same_as_own_revision(self):
+        map_ = RevisionMap(
+            lambda: [Revision("abcd", None, branch_labels=["abcd"])]
+        )
+        assert_raises_message(
+            RevisionError,
+            "Branch name 'abcd' in revision abcd already used by "
+            "revision abcd",
+            getattr,
+            map_,
+            "heads",
+        )
+
     def test_repr_revs(self):
         map_ = RevisionMap(
             lambda: [
@@ -1275,6 +1349,28 @@ class LargeMapTest(DownIterateTest):
             if remaining:
                 assert remaining.intersection(ancestors)
 
+    def test_filter_into_branch_heads_not_memoized(self):
+        map_ = RevisionMap(lambda: _large_map.data)
+        raw = [r for r in map_._revision_map.values() if r is not None]
+
+        eq_(
+            map_._filter_into_branch_heads(raw),
+            set(map_.get_revisions(map_.heads)),
+        )
+        eq_(map_._ancestor_cache, {})
+        eq_(map_._descendant_cache, {})
+
+    def test_memoized_traversals_bounded(self):
+        map_ = RevisionMap(lambda: _large_map.data)
+        raw = [r for r in map_._revision_map.values() if r is not None]
+
+        for rev in raw:
+            map_._get_ancestor_nodes([rev], memoize=True)
+            map_._get_descendant_nodes([rev], memoize=True)
+
+        for cache in (map_._ancestor_cache, map_._descendant_cache):
+            assert len(cache) <= cache.capacity * (1 + cache.threshold)
+
 
 class DepResolutionFailedTest(DownIterateTest):
     def setUp(self):
@@ -1513,6 +1609,23 @@ class GraphWithCycleTest(InvalidRevisionMapTest):
         )
         self._assert_raises_revision_map_cycle(map_, ["a", "b", "c", "d", "e"])
 
+    def test_revision_map_cycle_between_head_and_base(self):
+        map_ = RevisionMap(
+            lambda: [
+                Revision("a", ()),
+                Revision("b", "a"),
+                Revision("c", ("b", "e")),
+                Revision("d", "c"),
+                Revision("e", "d"),
+                Revision("f", "e"),
+            ]
+        )
+        self._assert_raises_revision_map(
+            map_,
+            CycleDetected,
+            r"^Cycle is detected in revisions \(c, d, e\)$",
+        )
+
     def test_revision_map_simple_dep_cycle(self):
         map_ = RevisionMap(
             lambda: [
@@ -1549,6 +1662,23 @@ class GraphWithCycleTest(InvalidRevisionMapTest):
             map_, ["a", "b", "c", "d", "e"]
         )
 
+    def test_revision_map_dep_cycle_between_head_and_base(self):
+        map_ = RevisionMap(
+            lambda: [
+                Revision("a", ()),
+                Revision("b", "a"),
+                Revision("c", "b", dependencies="e"),
+                Revision("d", "c"),
+                Revision("e", "d"),
+                Revision("f", "e"),
+            ]
+        )
+        self._assert_raises_revision_map(
+            map_,
+            DependencyCycleDetected,
+            r"^Dependency cycle is detected in revisions \(c, d, e\)$",
+        )
+
     def test_revision_map_upper_simple_dep_cycle(self):
         map_ = RevisionMap(
             lambda: [